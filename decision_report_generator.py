@@ -7,20 +7,31 @@
 # (executive vs instructional) that persists across sessions.
 
 from __future__ import annotations
+import asyncio
+import base64
+import hashlib
 import io
 import json
 import logging
 import os
 import subprocess
-from typing import Any, Dict, Optional
+import tempfile
+import threading
+import time
+from typing import Annotated, Any, Dict, Optional
+from urllib.parse import quote
 
 import boto3
+from botocore.config import Config
+from cachetools import TTLCache
+import jwt
+import orjson
 import psycopg2
 from fastapi import Depends, FastAPI, HTTPException, Query, Request
-from fastapi.responses import FileResponse
-from jose import jwk, jwt as jose_jwt
+from fastapi.responses import Response
+from jwt import PyJWKClient
 from psycopg2.extras import RealDictCursor
-import requests
+from starlette.background import BackgroundTask
 
 # ---------------------------------------------------------------------------
 ## CONFIGURATION & CLIENTS
@@ -29,10 +40,20 @@ DB_SECRET_ID       = os.environ["DB_SECRET_ID"]
 JWKS_URL           = os.environ["JWKS_URL"]
 REPORT_BUCKET      = os.environ.get("REPORT_BUCKET")    # S3 bucket for PDFs
 LATEX_TEMPLATE_DIR = os.environ.get("LATEX_TEMPLATE_DIR", "/templates")
+JWKS_TTL           = int(os.environ.get("JWKS_TTL", "3600"))  # seconds between JWKS refreshes
+JWKS_REFRESH_MIN   = int(os.environ.get("JWKS_REFRESH_MIN", "60"))  # min seconds between forced JWKS refetches
+TOKEN_CACHE_TTL    = int(os.environ.get("TOKEN_CACHE_TTL", "60"))  # seconds a verified token is reused
+AWS_POOL_SIZE      = int(os.environ.get("AWS_POOL_SIZE", "64"))  # keep-alive connections per AWS client
 
 # AWS clients
 ssm = boto3.client("secretsmanager")
-s3  = boto3.client("s3")
+# One pooled, keep-alive S3 client shared by background uploads; adaptive
+# retries back off under throttling instead of failing the upload
+s3  = boto3.client(
+    "s3",
+    config=Config(max_pool_connections=AWS_POOL_SIZE, tcp_keepalive=True,
+                  retries={"mode": "adaptive", "max_attempts": 5}),
+)
 
 # Postgres connection
 # Assumes a table user_preferences(user_id PK, writer_mode TEXT)
@@ -40,25 +61,81 @@ db_cfg = json.loads(ssm.get_secret_value(SecretId=DB_SECRET_ID)["SecretString"])
 conn = psycopg2.connect(**db_cfg, sslmode="require", cursor_factory=RealDictCursor)
 conn.autocommit = True
 
-# JWT verification via JWKS
-jwks = requests.get(JWKS_URL, timeout=3).json()
-key_set = {k['kid']: k for k in jwks['keys']}
+# JWT verification via JWKS; parsed signing keys are kept by kid for
+# JWKS_TTL seconds (handles key rotation)
+jwks_client = PyJWKClient(JWKS_URL, lifespan=JWKS_TTL, timeout=3)
 
 app = FastAPI(title="Decision Report Generator", version="0.2")
 
 # ---------------------------------------------------------------------------
 ## AUTHENTICATION
 # ---------------------------------------------------------------------------
-def verify_jwt(token: str = Depends(lambda req: req.headers.get("Authorization"," ").split()[-1])):
-    """Validate JWT via JWKS"""
-    if not token:
+token_cache: TTLCache = TTLCache(maxsize=10_000, ttl=TOKEN_CACHE_TTL)
+token_lock = threading.Lock()  # verify_jwt runs in the threadpool; TTLCache is not thread-safe
+jwks_lock = threading.Lock()
+jwks_keys: Dict[str, Any] = {}  # kid -> PyJWK, rebuilt only when the JWKS is fetched
+jwks_expires = 0.0       # monotonic time the current key map goes stale
+jwks_last_refresh = 0.0  # monotonic time of the last JWKS fetch
+
+
+def load_jwks() -> None:
+    """Fetch the JWKS and rebuild the kid -> PyJWK map (caller holds jwks_lock)."""
+    global jwks_keys, jwks_expires, jwks_last_refresh
+    keys = jwks_client.get_signing_keys(refresh=True)
+    jwks_keys = {k.key_id: k for k in keys}
+    jwks_last_refresh = time.monotonic()
+    jwks_expires = jwks_last_refresh + JWKS_TTL
+
+
+def signing_key_for(kid: str):
+    """
+    Resolve `kid` from the prebuilt key map. The JWKS is refetched when
+    JWKS_TTL lapses; unknown kids force a refetch at most once per
+    JWKS_REFRESH_MIN seconds, so forged kids can't drive outbound requests.
+    """
+    key = jwks_keys.get(kid)
+    if key is not None and time.monotonic() < jwks_expires:
+        return key
+    with jwks_lock:
+        now = time.monotonic()
+        if now >= jwks_expires or (
+            kid not in jwks_keys and now - jwks_last_refresh >= JWKS_REFRESH_MIN
+        ):
+            load_jwks()
+        key = jwks_keys.get(kid)
+    if key is None:
+        raise jwt.PyJWKClientError(f'Unable to find a signing key that matches: "{kid}"')
+    return key
+
+
+def bearer_token(request: Request) -> str:
+    """Extract the bearer token from the Authorization header."""
+    auth_header = request.headers.get("Authorization", "")
+    if not auth_header.startswith("Bearer "):
         raise HTTPException(401, "Missing bearer token")
-    header = jose_jwt.get_unverified_header(token)
-    key_data = key_set.get(header['kid'])
-    if not key_data:
+    return auth_header[7:]
+
+
+def verify_jwt(token: str = Depends(bearer_token)):
+    """Validate JWT via JWKS"""
+    ## Repeat tokens skip the RSA verify until TOKEN_CACHE_TTL or `exp`
+    digest = hashlib.sha256(token.encode()).digest()
+    with token_lock:
+        cached = token_cache.get(digest)
+    if cached and cached.get('exp', float('inf')) > time.time():
+        return cached
+    try:
+        seg = token.split(".", 1)[0]
+        header = orjson.loads(base64.urlsafe_b64decode(seg + "=" * (-len(seg) % 4)))
+        signing_key = signing_key_for(header['kid'])
+    except (ValueError, KeyError, jwt.PyJWKClientError):
         raise HTTPException(401, "Invalid token key ID")
-    key = jwk.construct(key_data)
-    payload = jose_jwt.decode(token, key.to_dict(), algorithms=[header['alg']])
+    try:
+        payload = jwt.decode(token, signing_key.key, algorithms=["RS256"])
+    except jwt.InvalidTokenError:
+        raise HTTPException(401, "Invalid token")
+    with token_lock:
+        token_cache[digest] = payload
     return payload  # contains 'sub' as user_id
 
 # ---------------------------------------------------------------------------
@@ -95,7 +172,11 @@ def fetch_report_data(project_id: str) -> Dict[str, Any]:
             raise HTTPException(404, "Project not found")
         data: Dict[str, Any] = {'project_name': proj['name']}
 
-        cur.execute("SELECT * FROM quotes WHERE project_id=%s", (project_id,))
+        # Only the columns the narrative uses (no etag/uploaded_at bookkeeping)
+        cur.execute(
+            "SELECT vendor, trade, price, scope, inclusions, exclusions, terms "
+            "FROM quotes WHERE project_id=%s", (project_id,)
+        )
         data['quotes'] = cur.fetchall()
 
         cur.execute("SELECT trade, scope_json FROM trade_scopes WHERE project_id=%s", (project_id,))
@@ -151,24 +232,24 @@ def render_pdf(data: Dict[str, Any], tone: str) -> bytes:
     tex_filled = tex.replace('{{PROJECT_NAME}}', data['project_name'])
     tex_filled = tex_filled.replace('{{NARRATIVE}}', narrative)
 
-    # Write + compile
-    tmpdir = '/tmp'
-    path = os.path.join(tmpdir, 'report.tex')
-    with open(path, 'w') as f:
-        f.write(tex_filled)
-    subprocess.run(['pdflatex', '-output-directory', tmpdir, path], check=True)
-    pdf_path = os.path.join(tmpdir, 'report.pdf')
-    with open(pdf_path, 'rb') as f:
-        return f.read()
+    # Write + compile in a private dir: renders run concurrently in worker threads
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'report.tex')
+        with open(path, 'w') as f:
+            f.write(tex_filled)
+        subprocess.run(['pdflatex', '-output-directory', tmpdir, path], check=True)
+        pdf_path = os.path.join(tmpdir, 'report.pdf')
+        with open(pdf_path, 'rb') as f:
+            return f.read()
 
 # ---------------------------------------------------------------------------
 ## /generate-report ENDPOINT
 # ---------------------------------------------------------------------------
 @app.post('/generate-report')
 async def generate_report(
-    project_id: str = Query(...),
-    tone: Optional[str] = Query(None, regex='^(executive|instructional)$'),
-    auth: Any = Depends(verify_jwt)
+    project_id: Annotated[str, Query()],
+    auth: Annotated[Any, Depends(verify_jwt)],
+    tone: Annotated[Optional[str], Query(pattern='^(executive|instructional)$')] = None,
 ):
     """
     Generate the final decision report PDF, respecting a persisted writer_mode.
@@ -177,30 +258,52 @@ async def generate_report(
     last-saved writer_mode (defaulting to 'executive').
     """
     user_id = auth['sub']
-    # Determine tone
-    if tone:
-        selected = tone
-        persist_writer_mode(user_id, selected)
-    else:
-        stored = fetch_writer_mode(user_id)
-        selected = stored if stored in PROMPT_TEMPLATES else 'executive'
+    # Fetch data while the tone is resolved
+    data_task = asyncio.create_task(asyncio.to_thread(fetch_report_data, project_id))
+
+    # Determine tone (an explicit override is persisted while we render)
+    persist_task = None
+    try:
+        if tone:
+            selected = tone
+            persist_task = asyncio.create_task(
+                asyncio.to_thread(persist_writer_mode, user_id, selected)
+            )
+        else:
+            stored = await asyncio.to_thread(fetch_writer_mode, user_id)
+            selected = stored if stored in PROMPT_TEMPLATES else 'executive'
 
-    # Fetch data + render
-    data = fetch_report_data(project_id)
-    pdf_bytes = render_pdf(data, selected)
+        # Render off the event loop (LLM call + pdflatex both block)
+        data = await data_task
+        pdf_bytes = await asyncio.to_thread(render_pdf, data, selected)
+        # Surface a failed save before any bytes go out
+        if persist_task:
+            await persist_task
+    except BaseException:
+        # Don't leave sibling work running unawaited (or its errors unretrieved)
+        await asyncio.gather(*(t for t in (data_task, persist_task) if t),
+                             return_exceptions=True)
+        raise
 
-    # Optionally upload
+    # Optionally upload, after the response has been sent
+    upload = None
     if REPORT_BUCKET:
         key = f"reports/{project_id}_{selected}.pdf"
-        s3.put_object(Bucket=REPORT_BUCKET, Key=key, Body=pdf_bytes)
-
-    # Return file
-    outfile = f"/tmp/report.pdf"
-    with open(outfile, 'wb') as f:
-        f.write(pdf_bytes)
-    return FileResponse(
-        path=outfile, media_type='application/pdf',
-        filename=f"{project_id}_{selected}_report.pdf"
+        upload = BackgroundTask(s3.put_object, Bucket=REPORT_BUCKET, Key=key, Body=pdf_bytes,
+                                ContentType="application/pdf")
+
+    # Return the PDF straight from memory (keeps Content-Length)
+    ## Same quoting as FileResponse: RFC 5987 filename* for anything non-ASCII/unsafe
+    filename = f"{project_id}_{selected}_report.pdf"
+    quoted = quote(filename)
+    if quoted != filename:
+        disposition = f"attachment; filename*=utf-8''{quoted}"
+    else:
+        disposition = f'attachment; filename="{filename}"'
+    return Response(
+        pdf_bytes, media_type='application/pdf',
+        headers={'Content-Disposition': disposition},
+        background=upload,
     )
 
 
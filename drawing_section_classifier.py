@@ -15,8 +15,10 @@ import io
 import json
 import logging
 import boto3
+from botocore.config import Config
 import pdfplumber
 import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Tuple
 from psycopg2.extras import execute_values
 import psycopg2
@@ -35,10 +37,17 @@ ANTHROPIC_SECRET = os.environ["ANTHROPIC_SECRET"]
 OPENAI_SECRET = os.environ["OPENAI_SECRET"]
 SENSITIVITY = os.environ.get("SENSITIVITY", "normal")
 TABLE = os.environ.get("TABLE_CLASS", "sheet_class")
+MAX_CONCURRENCY = int(os.environ.get("MAX_CONCURRENCY", 8))  # sheets in flight per invocation
+AWS_POOL_SIZE = int(os.environ.get("AWS_POOL_SIZE", "64"))  # keep-alive connections per AWS client
 
 # AWS & DB clients
 ssm = boto3.client("secretsmanager")
-s3  = boto3.client("s3")
+# pooled keep-alive clients shared by the sheet workers (boto3 client creation is not thread-safe)
+aws_cfg = Config(max_pool_connections=AWS_POOL_SIZE, tcp_keepalive=True,
+                 retries={"mode": "adaptive", "max_attempts": 5})
+s3  = boto3.client("s3", config=aws_cfg)
+textract = boto3.client("textract", config=aws_cfg)
+sagemaker = boto3.client("sagemaker-runtime", config=aws_cfg)
 # fetch secrets
 db_cfg = json.loads(ssm.get_secret_value(SecretId=DB_SECRET_ID)["SecretString"])
 conn = psycopg2.connect(**db_cfg, sslmode="require")
@@ -56,12 +65,12 @@ def ocr_text_from_s3(key: str) -> str:
     obj = s3.get_object(Bucket=BUCKET, Key=key)
     data = obj["Body"].read()
     with pdfplumber.open(io.BytesIO(data)) as pdf:
-        txt = pdf.pages[0].extract_text() or ""
+        # simple (no layout clustering) path: the LLM only needs the characters
+        txt = pdf.pages[0].extract_text_simple() or ""
     if txt.strip():
         return txt
     # fallback to Textract if empty
-    tex = boto3.client("textract")
-    res = tex.detect_document_text(Document={"Bytes": data})
+    res = textract.detect_document_text(Document={"Bytes": data})
     return "\n".join([b["Text"] for b in res["Blocks"] if b["BlockType"] == "LINE"])
 
 async def caption_image(key: str) -> str:
@@ -69,7 +78,7 @@ async def caption_image(key: str) -> str:
     try:
         thumb_key = key.replace(".pdf", ".png").replace("full/", "thumb/")
         img = s3.get_object(Bucket=BUCKET, Key=thumb_key)["Body"].read()
-        resp = boto3.client("sagemaker-runtime").invoke_endpoint(
+        resp = sagemaker.invoke_endpoint(
             EndpointName=CAPTION_ENDPOINT,
             ContentType="application/x-image",
             Body=img,
@@ -92,28 +101,40 @@ async def call_llm(model: str, prompt: str) -> dict:
     # (omitted for brevity)
     return {}
 
+def classify_sheet(sheet_id: str, key: str) -> Tuple[str, str]:
+    """OCR + caption + LLM for one sheet; returns (trade, context text)."""
+    LOG.info("Processing sheet %s", key)
+    text = ocr_text_from_s3(key)
+    caption = asyncio.run(caption_image(key))
+    prompt = f"Sheet {sheet_id} caption:\n{caption}\nText:\n{text}"
+    model = "gpt-4o-128k"  # could router based on size
+    result = asyncio.run(call_llm(model, prompt))
+    return result.get("trade", "Unknown"), caption + text
+
 # ------------------ MAIN --------------------
 def lambda_handler(event, context):
     """S3 event triggers classification of new drawings."""
     records = event.get("Records", [])
-    tasks: List[Tuple[str,str]] = []
+    tasks: List[Tuple[str,str,str]] = []
     for r in records:
         key = r["s3"]["object"]["key"]
         if not key.endswith(".pdf"): continue
         project_id, sheet_id = key.split("/",2)[1:3]
-        tasks.append((project_id, key))
+        tasks.append((project_id, sheet_id, key))
+    if not tasks:
+        return {"status":"ok"}
+
+    # Sheets are network-bound (S3, SageMaker, LLM): run up to MAX_CONCURRENCY at once
+    with ThreadPoolExecutor(max_workers=min(MAX_CONCURRENCY, len(tasks))) as pool:
+        results = list(pool.map(lambda t: classify_sheet(t[1], t[2]), tasks))
 
+    # one batched encode + one insert for the whole invocation
+    embs = EMB_MODEL.encode([ctx for _, ctx in results])
+    rows = [
+        (project_id, sheet_id, trade, json.dumps(emb.tolist()))
+        for (project_id, sheet_id, _), (trade, _), emb in zip(tasks, results, embs)
+    ]
     with conn.cursor() as cur:
-        for project_id, key in tasks:
-            LOG.info("Processing sheet %s", key)
-            text = ocr_text_from_s3(key)
-            caption = asyncio.run(caption_image(key))
-            prompt = f"Sheet {sheet_id} caption:\n{caption}\nText:\n{text}"
-            model = "gpt-4o-128k"  # could router based on size
-            result = asyncio.run(call_llm(model, prompt))
-            trade = result.get("trade", "Unknown")
-            emb = EMB_MODEL.encode(caption + text).tolist()
-            # insert
-            sql = f"INSERT INTO {TABLE}(project_id,sheet_id,trade,embedding) VALUES %s"
-            execute_values(cur, sql, [ (project_id, sheet_id, trade, json.dumps(emb)) ])
+        sql = f"INSERT INTO {TABLE}(project_id,sheet_id,trade,embedding) VALUES %s"
+        execute_values(cur, sql, rows)
     return {"status":"ok"}
\ No newline at end of file
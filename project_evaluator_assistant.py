@@ -20,21 +20,29 @@ This FastAPI service answers PM-style queries on a project using:
 """
 from __future__ import annotations
 import asyncio
+import base64
+import hashlib
 import json
 import logging
 import os
+import threading
 import time
-from typing import Any, Dict, List, Tuple
-from math import sqrt
+from collections import OrderedDict, deque
+from typing import Any, AsyncIterator, Dict, List, Tuple
 
 import boto3
+from botocore.config import Config
+from cachetools import TTLCache
+import numpy as np
 import openai
+import jwt
+import orjson
 import psycopg2
 from fastapi import Depends, FastAPI, HTTPException, Request
 from fastapi.responses import StreamingResponse
-from jose import jwk, jwt as jose_jwt
+from jwt import PyJWKClient
 from psycopg2.extras import RealDictCursor
-import requests
+import xxhash
 
 # ---------------------------------------------------------------------------
 ## CONFIGURATION & CLIENTS
@@ -45,61 +53,233 @@ JWKS_URL              = os.environ["JWKS_URL"]         # e.g. Auth0 JWKS
 RFI_QUEUE_URL         = os.environ.get("RFI_QUEUE_URL")  # SQS URL for auto-RFI
 CONFIDENCE_THRESHOLD  = float(os.environ.get("CONFIDENCE_THRESHOLD", "0.7"))
 K_RETRIEVE            = int(os.environ.get("RAG_TOP_K", "5"))
+JWKS_TTL              = int(os.environ.get("JWKS_TTL", "3600"))  # seconds between JWKS refreshes
+JWKS_REFRESH_MIN      = int(os.environ.get("JWKS_REFRESH_MIN", "60"))  # min seconds between forced JWKS refetches
+TOKEN_CACHE_TTL       = int(os.environ.get("TOKEN_CACHE_TTL", "60"))  # seconds a verified token is reused
+PROJECT_CTX_TTL       = int(os.environ.get("PROJECT_CTX_TTL", "30"))  # seconds project context is reused
+AWS_POOL_SIZE         = int(os.environ.get("AWS_POOL_SIZE", "64"))    # keep-alive connections per AWS client
+EMB_CACHE_MAX         = int(os.environ.get("EMB_CACHE_MAX", "50000"))
+EMB_MODEL             = "text-embedding-ada-002"
+EMB_DIM               = 1536
+EMB_BATCH_WAIT        = float(os.environ.get("EMB_BATCH_WAIT_MS", "10")) / 1000
+EMB_BATCH_SIZE        = 2048  # max inputs per embeddings request
+RFI_BATCH_WAIT        = float(os.environ.get("RFI_BATCH_WAIT_MS", "100")) / 1000
+RFI_MAX_INFLIGHT      = int(os.environ.get("RFI_MAX_INFLIGHT", "16"))  # concurrent confidence checks
+SQS_BATCH_MAX         = 10    # hard limit of SendMessageBatch
 
 # AWS & service clients
 ssm = boto3.client("secretsmanager")
-sqs = boto3.client("sqs")
+# One pooled, keep-alive SQS client shared by every request; adaptive
+# retries back off under throttling
+sqs = boto3.client(
+    "sqs",
+    config=Config(max_pool_connections=AWS_POOL_SIZE, tcp_keepalive=True,
+                  retries={"mode": "adaptive", "max_attempts": 5}),
+)
 
 # OpenAI API key
 secret = json.loads(ssm.get_secret_value(SecretId=OPENAI_SECRET)["SecretString"])
 openai.api_key = secret["OPENAI_API_KEY"]
+aclient = openai.AsyncOpenAI(api_key=secret["OPENAI_API_KEY"])
 
 # Postgres connection (for context + audit)
 db_cfg = json.loads(ssm.get_secret_value(SecretId=DB_SECRET_ID)["SecretString"])
 conn = psycopg2.connect(**db_cfg, sslmode="require", cursor_factory=RealDictCursor)
 conn.autocommit = True
 
-# Load JWKS for JWT verification
-jwks = requests.get(JWKS_URL, timeout=3).json()
-key_set = {k["kid"]: k for k in jwks["keys"]}
-
 # FastAPI app
 app = FastAPI(title="Project Evaluator & Assistant", version="0.3")
 
 # ---------------------------------------------------------------------------
 ## AUTHENTICATION DEPENDENCY
 # ---------------------------------------------------------------------------
+## Parsed signing keys are kept by kid for JWKS_TTL seconds, so key rotation
+## needs no restart; OpenSSL (via `cryptography`) does the RSA verify.
+jwks_client = PyJWKClient(JWKS_URL, lifespan=JWKS_TTL, timeout=3)
+
+token_cache: TTLCache = TTLCache(maxsize=10_000, ttl=TOKEN_CACHE_TTL)
+token_lock = threading.Lock()  # verify_jwt runs in the threadpool; TTLCache is not thread-safe
+jwks_lock = threading.Lock()
+jwks_keys: Dict[str, Any] = {}  # kid -> PyJWK, rebuilt only when the JWKS is fetched
+jwks_expires = 0.0       # monotonic time the current key map goes stale
+jwks_last_refresh = 0.0  # monotonic time of the last JWKS fetch
+
+
+def load_jwks() -> None:
+    """Fetch the JWKS and rebuild the kid -> PyJWK map (caller holds jwks_lock)."""
+    global jwks_keys, jwks_expires, jwks_last_refresh
+    keys = jwks_client.get_signing_keys(refresh=True)
+    jwks_keys = {k.key_id: k for k in keys}
+    jwks_last_refresh = time.monotonic()
+    jwks_expires = jwks_last_refresh + JWKS_TTL
+
 
-def verify_jwt(token: str = Depends(lambda req: req.headers.get("Authorization", "").split()[-1])):
+def signing_key_for(kid: str):
     """
-    Validate JWT using JWKS
+    Resolve `kid` from the prebuilt key map. The JWKS is refetched when
+    JWKS_TTL lapses; unknown kids force a refetch at most once per
+    JWKS_REFRESH_MIN seconds, so forged kids can't drive outbound requests.
     """
-    if not token:
+    key = jwks_keys.get(kid)
+    if key is not None and time.monotonic() < jwks_expires:
+        return key
+    with jwks_lock:
+        now = time.monotonic()
+        if now >= jwks_expires or (
+            kid not in jwks_keys and now - jwks_last_refresh >= JWKS_REFRESH_MIN
+        ):
+            load_jwks()
+        key = jwks_keys.get(kid)
+    if key is None:
+        raise jwt.PyJWKClientError(f'Unable to find a signing key that matches: "{kid}"')
+    return key
+
+
+def bearer_token(request: Request) -> str:
+    """Extract the bearer token from the Authorization header."""
+    auth_header = request.headers.get("Authorization", "")
+    if not auth_header.startswith("Bearer "):
         raise HTTPException(401, "Missing bearer token")
-    header = jose_jwt.get_unverified_header(token)
-    key_data = key_set.get(header["kid"])
-    if not key_data:
+    return auth_header[7:]
+
+
+def verify_jwt(token: str = Depends(bearer_token)):
+    """
+    Validate JWT using JWKS
+    """
+    ## Repeat tokens skip the RSA verify until TOKEN_CACHE_TTL or `exp`
+    digest = hashlib.sha256(token.encode()).digest()
+    with token_lock:
+        cached = token_cache.get(digest)
+    if cached and cached.get("exp", float("inf")) > time.time():
+        return cached
+    try:
+        seg = token.split(".", 1)[0]
+        header = orjson.loads(base64.urlsafe_b64decode(seg + "=" * (-len(seg) % 4)))
+        signing_key = signing_key_for(header["kid"])
+    except (ValueError, KeyError, jwt.PyJWKClientError):
         raise HTTPException(401, "Invalid token key ID")
-    key = jwk.construct(key_data)
-    payload = jose_jwt.decode(token, key.to_dict(), algorithms=[header["alg"]])
+    try:
+        payload = jwt.decode(token, signing_key.key, algorithms=["RS256"])
+    except jwt.InvalidTokenError:
+        raise HTTPException(401, "Invalid token")
+    with token_lock:
+        token_cache[digest] = payload
     return payload  # contains `sub` as user_id
 
 # ---------------------------------------------------------------------------
 ## UTILITY: COSINE SIMILARITY
 # ---------------------------------------------------------------------------
 
-def cosine_similarity(a: List[float], b: List[float]) -> float:
-    """Compute cosine similarity between two vectors."""
-    dot = sum(x * y for x, y in zip(a, b))
-    mag = sqrt(sum(x * x for x in a)) * sqrt(sum(y * y for y in b))
-    return dot / mag if mag else 0.0
+def cosine_similarity(q: np.ndarray, docs: np.ndarray) -> np.ndarray:
+    """Cosine similarity of one query vector against each row of `docs`."""
+    mag = np.linalg.norm(docs, axis=1) * np.linalg.norm(q)
+    dots = docs @ q
+    return np.divide(dots, mag, out=np.zeros_like(dots), where=mag > 0)
+
+
+def decode_embedding(b64: str) -> np.ndarray:
+    """Decode a base64 `encoding_format` embedding straight into float32."""
+    return np.frombuffer(base64.b64decode(b64), dtype=np.float32)
+
+# ---------------------------------------------------------------------------
+## EMBEDDING MICRO-BATCHER
+# ---------------------------------------------------------------------------
+# Concurrent /query requests that arrive within EMB_BATCH_WAIT share one
+# embeddings call; each caller gets back its own slice via a future.
+class EmbeddingBatcher:
+    def __init__(self, wait: float = EMB_BATCH_WAIT, size: int = EMB_BATCH_SIZE):
+        self.wait = wait
+        self.size = size
+        self.pending: "deque[Tuple[List[str], asyncio.Future]]" = deque()
+        self.task: asyncio.Task | None = None
+
+    async def embed(self, texts: List[str]) -> List[np.ndarray]:
+        """Queue `texts` for the next batch and wait for their vectors."""
+        fut = asyncio.get_running_loop().create_future()
+        self.pending.append((texts, fut))
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+        return await fut
+
+    async def _run(self):
+        while self.pending:
+            await asyncio.sleep(self.wait)
+            batch, n = [], 0
+            while self.pending and (not batch or n + len(self.pending[0][0]) <= self.size):
+                texts, fut = self.pending.popleft()
+                batch.append((texts, fut))
+                n += len(texts)
+            await self._flush(batch)
+
+    async def _flush(self, batch: List[Tuple[List[str], asyncio.Future]]):
+        inputs = [t for texts, _ in batch for t in texts]
+        # Any failure (request, decode, short response) must reach every
+        # waiter, or their /query calls hang on an unresolved future
+        try:
+            resp = await aclient.embeddings.create(
+                model=EMB_MODEL, input=inputs, encoding_format="base64"
+            )
+            vecs = [decode_embedding(r.embedding) for r in resp.data]
+            if len(vecs) != len(inputs):
+                raise RuntimeError(f"embeddings returned {len(vecs)} vectors for {len(inputs)} inputs")
+        except Exception as exc:
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(exc)
+            return
+        offset = 0
+        for texts, fut in batch:
+            if not fut.done():
+                fut.set_result(vecs[offset:offset + len(texts)])
+            offset += len(texts)
+
+
+embedder = EmbeddingBatcher()
+
+# ---------------------------------------------------------------------------
+## EMBEDDING CACHE
+# ---------------------------------------------------------------------------
+# Quote/scope candidate strings repeat across questions, so their embeddings
+# are kept in an in-process LRU keyed by an xxh64 content hash.
+EMB_CACHE: "OrderedDict[int, np.ndarray]" = OrderedDict()
+
+
+async def embed_cached(texts: List[str]) -> np.ndarray:
+    """Embed `texts` into an (N, EMB_DIM) float32 array, sending only cache
+    misses to the embeddings API."""
+    hashes = [xxhash.xxh64(t).intdigest() for t in texts]
+    found: Dict[int, np.ndarray] = {}
+    miss: Dict[int, str] = {}
+    for h, t in zip(hashes, texts):
+        vec = EMB_CACHE.get(h)
+        if vec is not None:
+            EMB_CACHE.move_to_end(h)
+            found[h] = vec
+        else:
+            miss.setdefault(h, t)
+    if miss:
+        vecs = await embedder.embed(list(miss.values()))
+        for h, v in zip(miss, vecs):
+            EMB_CACHE[h] = found[h] = v
+    embeddings = np.empty((len(hashes), EMB_DIM), dtype=np.float32)
+    for i, h in enumerate(hashes):
+        embeddings[i] = found[h]
+    while len(EMB_CACHE) > EMB_CACHE_MAX:
+        EMB_CACHE.popitem(last=False)
+    return embeddings
+
+
+async def embed_question(question: str) -> np.ndarray:
+    """Embed the question on its own so it can overlap the context fetch."""
+    return (await embedder.embed([question]))[0]
 
 # ---------------------------------------------------------------------------
 ## CONTEXT RETRIEVAL (RAG)
 # ---------------------------------------------------------------------------
-async def retrieve_context(question: str, ctx: Dict[str, Any]) -> str:
+async def retrieve_context(q_emb: np.ndarray, ctx: Dict[str, Any]) -> str:
     """
-    1) Embed question + document candidates
+    1) Embed document candidates (question arrives pre-embedded)
     2) Score and select top-K
     3) Return tagged snippets for LLM proof
     """
@@ -113,19 +293,14 @@ async def retrieve_context(question: str, ctx: Dict[str, Any]) -> str:
         items = s['scope_json'].get('scope_items', [])
         txt = f"SCOPE[{s['trade']}]: {len(items)} items"
         candidates.append((f"scope:{s['trade']}", txt))
-    texts = [question] + [t for _, t in candidates]
+    texts = [t for _, t in candidates]
 
-    # Embed all texts
-    resp = openai.embeddings.create(model="text-embedding-ada-002", input=texts)
-    embeddings = [r['embedding'] for r in resp['data']]
-    q_emb = embeddings[0]
-    doc_embs = embeddings[1:]
+    # Embed candidates (cache hits skip the API)
+    doc_embs = await embed_cached(texts)
 
     # Score similarity
-    scored = []
-    for (tag, txt), emb in zip(candidates, doc_embs):
-        sim = cosine_similarity(q_emb, emb)
-        scored.append((sim, tag, txt))
+    sims = cosine_similarity(q_emb, doc_embs)
+    scored = [(float(sim), tag, txt) for sim, (tag, txt) in zip(sims, candidates)]
     scored.sort(reverse=True, key=lambda x: x[0])
     topk = scored[:K_RETRIEVE]
 
@@ -138,8 +313,42 @@ async def retrieve_context(question: str, ctx: Dict[str, Any]) -> str:
 # ---------------------------------------------------------------------------
 ## PROJECT CONTEXT FETCHER
 # ---------------------------------------------------------------------------
+## Context is cached per project for PROJECT_CTX_TTL seconds. A per-project
+## lock makes concurrent misses wait on one DB load instead of stampeding.
+## TTLCache is not thread-safe, so ctx_cache_lock guards every cache access
+## (and ctx_locks); per-project locks are refcounted and dropped when idle.
+ctx_cache: TTLCache = TTLCache(maxsize=1024, ttl=PROJECT_CTX_TTL)
+ctx_cache_lock = threading.Lock()
+ctx_locks: Dict[str, List[Any]] = {}  # project_id -> [lock, waiters]
+
 
 def fetch_project_context(project_id: str) -> Dict[str, Any]:
+    """
+    Return cached project context, loading it once per TTL window
+    """
+    with ctx_cache_lock:
+        ctx = ctx_cache.get(project_id)
+        if ctx is not None:
+            return ctx
+        entry = ctx_locks.setdefault(project_id, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            with ctx_cache_lock:
+                ctx = ctx_cache.get(project_id)
+            if ctx is None:
+                ctx = load_project_context(project_id)
+                with ctx_cache_lock:
+                    ctx_cache[project_id] = ctx
+    finally:
+        with ctx_cache_lock:
+            entry[1] -= 1
+            if not entry[1]:
+                del ctx_locks[project_id]
+    return ctx
+
+
+def load_project_context(project_id: str) -> Dict[str, Any]:
     """
     Load project name, quotes, scopes, budget
     """
@@ -164,24 +373,22 @@ def fetch_project_context(project_id: str) -> Dict[str, Any]:
 # ---------------------------------------------------------------------------
 ## LLM INVOCATION
 # ---------------------------------------------------------------------------
-async def ask_llm_stream(model: str, system: str, prompt: str) -> str:
-    """Stream chat completion tokens."""
-    stream = openai.chat.completions.create(
+async def ask_llm_stream(model: str, system: str, prompt: str) -> AsyncIterator[str]:
+    """Stream chat completion tokens (caller accumulates the answer)."""
+    # Async client: the blocking request and chunk reads stay off the event loop
+    stream = await aclient.chat.completions.create(
         model=model,
         messages=[{'role':'system','content':system},{'role':'user','content':prompt}],
         temperature=0,
         stream=True
     )
-    result = ''
     async for chunk in stream:
-        delta = chunk.choices[0].delta.get('content', '')
-        result += delta
-        yield delta
-    return result
+        if chunk.choices:
+            yield chunk.choices[0].delta.content or ''
 
 async def ask_llm_once(model: str, system: str, prompt: str) -> str:
     """Single-turn chat completion (for confidence rating)."""
-    resp = openai.chat.completions.create(
+    resp = await aclient.chat.completions.create(
         model=model,
         messages=[{'role':'system','content':system},{'role':'user','content':prompt}],
         temperature=0
@@ -197,21 +404,77 @@ async def store_audit(
 ):
     """
     Write each query + proof to `query_audit` table for replay.
+    The blocking psycopg2 write runs in a worker thread.
     """
-    with conn.cursor() as cur:
-        cur.execute(
-            """
-            INSERT INTO query_audit (project_id, user_id, question,
-                                     proof_context, quotes_json, scopes_json,
-                                     answer, created_at)
-            VALUES (%s,%s,%s,%s,%s,%s,%s, NOW())
-            """,
-            (project_id, user_id, question,
-             proof_ctx,
-             json.dumps(quotes),
-             json.dumps(scopes),
-             answer)
-        )
+    def write():
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                INSERT INTO query_audit (project_id, user_id, question,
+                                         proof_context, quotes_json, scopes_json,
+                                         answer, created_at)
+                VALUES (%s,%s,%s,%s,%s,%s,%s, NOW())
+                """,
+                (project_id, user_id, question,
+                 proof_ctx,
+                 json.dumps(quotes),
+                 json.dumps(scopes),
+                 answer)
+            )
+    await asyncio.to_thread(write)
+
+# ---------------------------------------------------------------------------
+## AUTO-RFI: SQS BATCHER
+# ---------------------------------------------------------------------------
+## RFIs raised within RFI_BATCH_WAIT of each other go out in one
+## SendMessageBatch call; each caller awaits its own entry's result.
+class SqsBatcher:
+    def __init__(self, queue_url: str, wait: float = RFI_BATCH_WAIT):
+        self.queue_url = queue_url
+        self.wait = wait
+        self.pending: "deque[Tuple[Dict[str, Any], asyncio.Future]]" = deque()
+        self.task: asyncio.Task | None = None
+
+    async def send(self, message: Dict[str, Any]) -> str:
+        """Queue `message` for the next batch; returns its SQS MessageId."""
+        fut = asyncio.get_running_loop().create_future()
+        self.pending.append((message, fut))
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+        return await fut
+
+    async def _run(self):
+        while self.pending:
+            if len(self.pending) < SQS_BATCH_MAX:
+                await asyncio.sleep(self.wait)
+            batch = [self.pending.popleft() for _ in range(min(SQS_BATCH_MAX, len(self.pending)))]
+            await self._flush(batch)
+
+    async def _flush(self, batch: List[Tuple[Dict[str, Any], asyncio.Future]]):
+        entries = [
+            {'Id': str(i), 'MessageBody': orjson.dumps(msg).decode()}
+            for i, (msg, _) in enumerate(batch)
+        ]
+        try:
+            resp = await asyncio.to_thread(
+                sqs.send_message_batch, QueueUrl=self.queue_url, Entries=entries
+            )
+        except Exception as exc:
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(exc)
+            return
+        for ok in resp.get('Successful', []):
+            fut = batch[int(ok['Id'])][1]
+            if not fut.done():
+                fut.set_result(ok['MessageId'])
+        for failed in resp.get('Failed', []):
+            fut = batch[int(failed['Id'])][1]
+            if not fut.done():
+                fut.set_exception(RuntimeError(f"SQS rejected RFI: {failed.get('Message')}"))
+
+
+rfi_batcher = SqsBatcher(RFI_QUEUE_URL) if RFI_QUEUE_URL else None
 
 # ---------------------------------------------------------------------------
 ## AUTO-RFI: CONFIDENCE CHECK & QUEUE
@@ -229,7 +492,7 @@ async def check_and_queue_rfi(answer: str, question: str, project_id: str, user_
         rating = json.loads(eval_json).get('confidence', 0.0)
     except:
         rating = 0.0
-    if rating < CONFIDENCE_THRESHOLD and RFI_QUEUE_URL:
+    if rating < CONFIDENCE_THRESHOLD and rfi_batcher:
         payload = {
             'project_id': project_id,
             'user_id': user_id,
@@ -238,9 +501,24 @@ async def check_and_queue_rfi(answer: str, question: str, project_id: str, user_
             'confidence': rating,
             'timestamp': time.time()
         }
-        sqs.send_message(QueueUrl=RFI_QUEUE_URL, MessageBody=json.dumps(payload))
+        await rfi_batcher.send(payload)
         logging.warning(f"Queued RFI (conf={rating:.2f}) for {project_id}")
 
+## Confidence checks run after the response; cap how many hit the LLM at once
+## and hold task refs so pending checks are not garbage-collected mid-flight
+rfi_sem = asyncio.Semaphore(RFI_MAX_INFLIGHT)
+rfi_tasks: set = set()
+
+async def _bounded_rfi_check(*args):
+    async with rfi_sem:
+        await check_and_queue_rfi(*args)
+
+def schedule_rfi_check(*args):
+    """Fire-and-forget check_and_queue_rfi, bounded by RFI_MAX_INFLIGHT."""
+    task = asyncio.create_task(_bounded_rfi_check(*args))
+    rfi_tasks.add(task)
+    task.add_done_callback(rfi_tasks.discard)
+
 # ---------------------------------------------------------------------------
 ## MODEL ROUTER
 # ---------------------------------------------------------------------------
@@ -251,6 +529,16 @@ def choose_model_alias(prompt_len: int) -> str:
 # ---------------------------------------------------------------------------
 ## /query ENDPOINT
 # ---------------------------------------------------------------------------
+## Static system prompt (asks for an explicit Proof section); built once
+QUERY_SYSTEM_PROMPT = (
+    "You are a senior construction PM assistant. "
+    "Use the provided sources. Answer in Markdown. "
+    "At the end, include a '## Proof' section with:\n"
+    "1) SOURCE tags (from context)\n"
+    "2) Parsed quote JSON snippet\n"
+    "3) Exact match/diff logic explanation\n"
+)
+
 @app.post('/query')
 async def query(request: Request, auth: Any = Depends(verify_jwt)):
     """
@@ -266,40 +554,34 @@ async def query(request: Request, auth: Any = Depends(verify_jwt)):
     question   = data['question']
     user_id    = auth['sub']
 
-    # Fetch project context
-    ctx = fetch_project_context(project_id)
-    proof_ctx = await retrieve_context(question, ctx)
-
-    # Build prompts (ask for explicit Proof section)
-    system_prompt = (
-        "You are a senior construction PM assistant. "
-        "Use the provided sources. Answer in Markdown. "
-        "At the end, include a '## Proof' section with:\n"
-        "1) SOURCE tags (from context)\n"
-        "2) Parsed quote JSON snippet\n"
-        "3) Exact match/diff logic explanation\n"
-    )
+    # Fetch project context while the question is embedded
+    async with asyncio.TaskGroup() as tg:
+        ctx_t = tg.create_task(asyncio.to_thread(fetch_project_context, project_id))
+        q_emb_t = tg.create_task(embed_question(question))
+    ctx = ctx_t.result()
+    proof_ctx = await retrieve_context(q_emb_t.result(), ctx)
+
+    # Build user prompt
     user_prompt = (
         f"Project {ctx['project_name']}\n"  
         f"Context:\n{proof_ctx}\n"  
         f"Question: {question}\n"
     )
 
-    # Prepare to collect answer
-    answer_buf = ''
     model_alias = choose_model_alias(len(user_prompt)//4)
-    
+
     async def stream_gen():
-        nonlocal answer_buf
-        # Stream answer
-        async for tok in ask_llm_stream(model_alias, system_prompt, user_prompt):
-            answer_buf += tok
+        # Stream answer; tokens are joined once at the end
+        parts: List[str] = []
+        append = parts.append
+        async for tok in ask_llm_stream(model_alias, QUERY_SYSTEM_PROMPT, user_prompt):
+            append(tok)
             yield tok
+        answer_buf = ''.join(parts)
         # Once complete: store audit and check RFI
         await store_audit(project_id, user_id, question,
                           proof_ctx, ctx['quotes'], ctx['scopes'], answer_buf)
-        asyncio.create_task(check_and_queue_rfi(answer_buf, question,
-                                                project_id, user_id, model_alias))
+        schedule_rfi_check(answer_buf, question, project_id, user_id, model_alias)
 
     return StreamingResponse(stream_gen(), media_type='text/markdown')
 
@@ -14,29 +14,40 @@ Workflow
 5. **On match**       – Insert single row (primary JSON) into Aurora, archive
 the PDF.
 
+A primary parse missing `vendor, trade, price` is a guaranteed mismatch, so it
+is queued for review straight away without spending a checker call.
+
 Environment additions
 ---------------------
 ```
 CHECK_MODEL="claude-3-sonnet-20240229"
 REVIEW_QUEUE_URL=https://sqs.us-east-1.amazonaws.com/123/quote_review_queue
 SENSITIVITY=normal|pii
+MAX_CONCURRENCY=8
+AWS_POOL_SIZE=64
 ```
 
 Dependencies update
 -------------------
 anthropic>=0.21.4
 rapidfuzz>=3.6.0
+pydantic>=2.0
+pdfplumber>=0.10.0
+orjson>=3.9
 
 """
 from __future__ import annotations
-import io, json, logging, os, re
+import io, logging, os, re
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from decimal import Decimal
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Tuple, Union
 
-import boto3, openai, pdfplumber, psycopg2
+import boto3, openai, orjson, pdfplumber, psycopg2
+from botocore.config import Config
 from rapidfuzz.fuzz import token_sort_ratio
 from psycopg2.extras import execute_values
+from pydantic import BaseModel, ValidationError
 import anthropic
 
 # --------------------------- CONFIG --------------------------------------
@@ -50,9 +61,16 @@ PRIMARY_MODEL = os.environ.get("GPT_MODEL", "gpt-4o-128k")
 CHECK_MODEL = os.environ.get("CHECK_MODEL", "claude-3-sonnet-20240229")
 REVIEW_QUEUE_URL = os.environ["REVIEW_QUEUE_URL"]
 SENSITIVITY = os.environ.get("SENSITIVITY", "normal")
+MAX_CONCURRENCY = int(os.environ.get("MAX_CONCURRENCY", "8"))  # records parsed in parallel
+MAX_TEXT_CHARS = 12000  # both models only ever see the first 12k chars
+
+_PRICE_RE = re.compile(r"[^0-9.]+")
+SQS_BATCH_MAX = 10
+SQS_SEND_ATTEMPTS = 3  # tries per batch before unsent review entries fail the invocation
+AWS_POOL_SIZE = int(os.environ.get("AWS_POOL_SIZE", "64"))  # keep-alive connections per AWS client
 
 ssm = boto3.client("secretsmanager")
-secrets = lambda sid: json.loads(ssm.get_secret_value(SecretId=sid)["SecretString"])
+secrets = lambda sid: orjson.loads(ssm.get_secret_value(SecretId=sid)["SecretString"])
 openai.api_key = secrets(SECRET_ID)["OPENAI_API_KEY"]
 claude_key = secrets(SECRET_ID).get("ANTHROPIC_API_KEY")  # same secret bundle
 
@@ -63,19 +81,42 @@ cfg = secrets(DB_SECRET_ID)
 conn = psycopg2.connect(**cfg, sslmode="require")
 conn.autocommit = True
 
-s3 = boto3.client("s3")
-sqs = boto3.client("sqs")
+# one pooled keep-alive config for every worker thread; adaptive retries back off under throttling
+aws_cfg = Config(max_pool_connections=AWS_POOL_SIZE, tcp_keepalive=True,
+                 retries={"mode": "adaptive", "max_attempts": 5})
+s3 = boto3.client("s3", config=aws_cfg)
+sqs = boto3.client("sqs", config=aws_cfg)
+
+# ----------------------- SCHEMA ------------------------------------------
+
+class PrimaryQuote(BaseModel):
+    vendor: str
+    trade: str
+    price: Union[float, str]
+    scope: List[str] = []
+    inclusions: List[Any] = []
+    exclusions: List[Any] = []
+    terms: Any = None
 
 # ----------------------- HELPERS -----------------------------------------
 
 def extract_text(blob: bytes) -> str:
+    # stream pages into one buffer; stop once both models' slice is filled
+    buf = io.StringIO()
     with pdfplumber.open(io.BytesIO(blob)) as pdf:
-        return "\n".join(p.extract_text() or "" for p in pdf.pages)
+        for p in pdf.pages:
+            t = p.extract_text_simple()
+            if t:
+                buf.write(t)
+                buf.write("\n")
+            if buf.tell() >= MAX_TEXT_CHARS:
+                break
+    return buf.getvalue()
 
 def normalise_price(p) -> Decimal | None:
     if p is None:
         return None
-    cleaned = re.sub(r"[^0-9.]+", "", str(p))
+    cleaned = _PRICE_RE.sub("", str(p))
     return Decimal(cleaned) if cleaned else None
 
 def call_openai(text: str) -> dict:
@@ -83,10 +124,10 @@ def call_openai(text: str) -> dict:
     resp = openai.chat.completions.create(
         model=PRIMARY_MODEL,
         response_format={"type": "json_object"},
-        messages=[{"role":"system","content":prompt},{"role":"user","content":text[:12000]}],
+        messages=[{"role":"system","content":prompt},{"role":"user","content":text[:MAX_TEXT_CHARS]}],
         temperature=0,
     )
-    return json.loads(resp.choices[0].message.content)
+    return orjson.loads(resp.choices[0].message.content)
 
 def call_claude(text: str) -> dict:
     prompt = (
@@ -97,9 +138,9 @@ def call_claude(text: str) -> dict:
         max_tokens=512,
         temperature=0,
         system="You are a checker.",
-        messages=[{"role":"user","content":text[:12000]}],
+        messages=[{"role":"user","content":text[:MAX_TEXT_CHARS]}],
     )
-    return json.loads(msg.content[0].text)
+    return orjson.loads(msg.content[0].text)
 
 def rows_equal(a: dict, b: dict) -> bool:
     if a.get("vendor","" ).strip().lower() != b.get("vendor","" ).strip().lower():
@@ -112,57 +153,109 @@ def rows_equal(a: dict, b: dict) -> bool:
     sim = token_sort_ratio(" ".join(a.get("scope",[])), " ".join(b.get("scope",[])))
     return sim >= 90
 
-def queue_for_review(bucket: str, key: str, prim: dict, check: dict):
-    sqs.send_message(
-        QueueUrl=REVIEW_QUEUE_URL,
-        MessageBody=json.dumps({"bucket":bucket,"key":key,"primary":prim,"check":check}),
-        MessageGroupId="quote", MessageDeduplicationId=key,
-    )
+def review_entry(bucket: str, key: str, prim: dict, check: dict) -> dict:
+    return {
+        "MessageBody": orjson.dumps({"bucket":bucket,"key":key,"primary":prim,"check":check}).decode(),
+        "MessageGroupId": "quote", "MessageDeduplicationId": key,
+    }
+
+def queue_for_review(entries: List[dict]):
+    # SendMessageBatch takes at most 10 entries per call; failed entries are re-sent,
+    # and anything still unsent raises so Lambda retries (FIFO dedup on key makes re-sends safe)
+    unsent = 0
+    for start in range(0, len(entries), SQS_BATCH_MAX):
+        pending = {str(i): e for i, e in enumerate(entries[start:start+SQS_BATCH_MAX])}
+        for _ in range(SQS_SEND_ATTEMPTS):
+            resp = sqs.send_message_batch(QueueUrl=REVIEW_QUEUE_URL, Entries=[{"Id": i, **e} for i, e in pending.items()])
+            failed = resp.get("Failed", [])
+            pending = {f["Id"]: pending[f["Id"]] for f in failed}
+            if not pending:
+                break
+        for f in failed:
+            logger.error("Review queue send failed for entry %s: %s", f["Id"], f.get("Message"))
+        unsent += len(pending)
+    if unsent:
+        raise RuntimeError(f"{unsent} review message(s) could not be queued")
 
 # ----------------------- CORE --------------------------------------------
 
 def insert_rows(rows: List[Dict[str, Any]]):
     sql = f"INSERT INTO {SHEET_TABLE}(etag, uploaded_at, vendor, trade, price, scope,inclusions,exclusions,terms) VALUES %s ON CONFLICT(etag) DO NOTHING"
-    vals=[(r["etag"],r["uploaded_at"],r["vendor"],r["trade"],r["price"],json.dumps(r["scope"]),json.dumps(r["inclusions"]),json.dumps(r["exclusions"]),r["terms"]) for r in rows]
+    vals=[(r["etag"],r["uploaded_at"],r["vendor"],r["trade"],r["price"],orjson.dumps(r["scope"]).decode(),orjson.dumps(r["inclusions"]).decode(),orjson.dumps(r["exclusions"]).decode(),r["terms"]) for r in rows]
     with conn.cursor() as cur:
         execute_values(cur,sql,vals)
 
 # ----------------------- HANDLER -----------------------------------------
 
-def lambda_handler(event,_):
-    inserted=0
-    for rec in event.get("Records",[]):
-        bucket,key,etag=rec["s3"]["bucket"]["name"],rec["s3"]["object"]["key"],rec["s3"]["object"]["eTag"]
-        logger.info("Quote %s",key)
-        # skip dup
-        with conn.cursor() as cur:
-            cur.execute(f"SELECT 1 FROM {SHEET_TABLE} WHERE etag=%s",(etag,))
-            if cur.fetchone():
-                continue
-        blob=s3.get_object(Bucket=bucket,Key=key)["Body"].read()
-        text=extract_text(blob)
-        primary=call_openai(text)
-        checker=call_claude(text)
-        if not rows_equal(primary,checker):
-            logger.warning("Mismatch on %s queued for review",key)
-            queue_for_review(bucket,key,primary,checker)
-            continue
-        row={
-            "etag":etag,
-            "uploaded_at":datetime.utcnow(),
-            "vendor":primary.get("vendor"),
-            "trade":primary.get("trade"),
-            "price":normalise_price(primary.get("price")),
-            "scope":primary.get("scope",[]),
-            "inclusions":primary.get("inclusions",[]),
-            "exclusions":primary.get("exclusions",[]),
-            "terms":primary.get("terms"),
-        }
-        insert_rows([row])
-        s3.copy_object(Bucket=bucket,CopySource={"Bucket":bucket,"Key":key},Key=key.replace("incoming/","processed/",1))
-        s3.delete_object(Bucket=bucket,Key=key)
-        inserted+=1
-    return {"inserted":inserted}
+def seen_etags(etags: List[str]) -> set:
+    """ETags already in SHEET_TABLE, looked up in one round-trip."""
+    with conn.cursor() as cur:
+        cur.execute(f"SELECT etag FROM {SHEET_TABLE} WHERE etag = ANY(%s)",(etags,))
+        return {r[0] for r in cur.fetchall()}
 
+def process_record(rec) -> Tuple[str, dict | None]:
+    """Parse one new S3 record; returns ("review"|"inserted", review entry)."""
+    bucket,key,etag=rec["s3"]["bucket"]["name"],rec["s3"]["object"]["key"],rec["s3"]["object"]["eTag"]
+    logger.info("Quote %s",key)
+    blob=s3.get_object(Bucket=bucket,Key=key)["Body"].read()
+    text=extract_text(blob)
+    primary=call_openai(text)
+    try:
+        PrimaryQuote.model_validate(primary)
+    except ValidationError:
+        logger.warning("Invalid primary parse on %s queued for review",key)
+        return "review",review_entry(bucket,key,primary,{"error":"invalid primary"})
+    checker=call_claude(text)
+    if not rows_equal(primary,checker):
+        logger.warning("Mismatch on %s queued for review",key)
+        return "review",review_entry(bucket,key,primary,checker)
+    row={
+        "etag":etag,
+        "uploaded_at":datetime.utcnow(),
+        "vendor":primary.get("vendor"),
+        "trade":primary.get("trade"),
+        "price":normalise_price(primary.get("price")),
+        "scope":primary.get("scope",[]),
+        "inclusions":primary.get("inclusions",[]),
+        "exclusions":primary.get("exclusions",[]),
+        "terms":primary.get("terms"),
+    }
+    insert_rows([row])
+    s3.copy_object(Bucket=bucket,CopySource={"Bucket":bucket,"Key":key},Key=key.replace("incoming/","processed/",1))
+    s3.delete_object(Bucket=bucket,Key=key)
+    return "inserted",None
 
+def try_record(rec) -> Tuple[str, dict | None]:
+    """process_record, but one bad record can't stop the others' reviews being queued."""
+    try:
+        return process_record(rec)
+    except Exception:
+        logger.exception("Failed on %s",rec["s3"]["object"]["key"])
+        return "error",None
 
+def lambda_handler(event,_):
+    records=event.get("Records",[])
+    # skip dups (already stored, or repeated within this batch)
+    seen=seen_etags([r["s3"]["object"]["eTag"] for r in records]) if records else set()
+    fresh=[]
+    for rec in records:
+        etag=rec["s3"]["object"]["eTag"]
+        if etag not in seen:
+            seen.add(etag)
+            fresh.append(rec)
+    records=fresh
+    if not records:
+        return {"inserted":0}
+    # each record is two LLM round-trips; overlap up to MAX_CONCURRENCY of them
+    with ThreadPoolExecutor(max_workers=min(MAX_CONCURRENCY,len(records))) as pool:
+        results=list(pool.map(try_record,records))
+    inserted=sum(1 for status,_ in results if status=="inserted")
+    reviews=[entry for status,entry in results if status=="review"]
+    errors=sum(1 for status,_ in results if status=="error")
+    if reviews:
+        queue_for_review(reviews)
+    # fail the invocation so Lambda retries: stored ETags are skipped and
+    # re-sent reviews dedupe on key, so a retry can't double-insert or double-queue
+    if errors:
+        raise RuntimeError(f"{errors} of {len(records)} quote record(s) failed")
+    return {"inserted":inserted}
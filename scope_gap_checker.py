@@ -11,21 +11,30 @@ Any missing scope items are returned and automatically queued for human review.
 - `POST /missing-scope` endpoint (JWT-secured)
 - Fetch data from Aurora Postgres (`trade_scopes`, `quotes`)
 - Compute missing items per trade
-- Push each gap to an SQS review queue (`SCOPE_REVIEW_QUEUE_URL`)
+- Push each gap to an SQS review queue (`SCOPE_REVIEW_QUEUE_URL`), batched
+  10 per `send_message_batch` call after the response is sent
 - Rich `##` code comments for developer clarity
 
 """
 from __future__ import annotations
+import asyncio
+import base64
+import hashlib
 import json
 import logging
 import os
+import threading
+import time
 from typing import Any, Dict, List
 
 import boto3
-import requests
+from botocore.config import Config
+from cachetools import TTLCache
+import jwt
+import orjson
 import psycopg2
-from fastapi import Depends, FastAPI, HTTPException, Request
-from jose import jwk, jwt as jose_jwt
+from fastapi import BackgroundTasks, Depends, FastAPI, HTTPException, Request
+from jwt import PyJWKClient
 from psycopg2.extras import RealDictCursor
 from starlette.middleware.cors import CORSMiddleware
 
@@ -35,9 +44,15 @@ from starlette.middleware.cors import CORSMiddleware
 DB_SECRET_ID             = os.environ["DB_SECRET_ID"]
 JWKS_URL                 = os.environ["JWKS_URL"]
 SCOPE_REVIEW_QUEUE_URL   = os.environ.get("SCOPE_REVIEW_QUEUE_URL")  # SQS for scope-review
+JWKS_TTL                 = int(os.environ.get("JWKS_TTL", "3600"))     # seconds between JWKS refreshes
+JWKS_REFRESH_MIN         = int(os.environ.get("JWKS_REFRESH_MIN", "60"))  # min seconds between forced JWKS refetches
+TOKEN_CACHE_TTL          = int(os.environ.get("TOKEN_CACHE_TTL", "60")) # seconds a verified token is reused
 
 # Thresholds and constants
 # (none for now -- we queue every missing item)
+SQS_BATCH_MAX            = 10   # hard limit of SendMessageBatch
+SQS_SEND_ATTEMPTS        = 3    # tries per batch before unsent entries raise
+AWS_POOL_SIZE            = int(os.environ.get("AWS_POOL_SIZE", "64"))  # keep-alive connections per AWS client
 
 # ---------------------------------------------------------------------------
 ## LOGGER
@@ -49,7 +64,13 @@ logger.setLevel(logging.INFO)
 ## AWS CLIENTS
 # ---------------------------------------------------------------------------
 ssm = boto3.client("secretsmanager")
-sqs = boto3.client("sqs")
+# One pooled, keep-alive SQS client shared by every request/background task;
+# adaptive retries back off under throttling
+sqs = boto3.client(
+    "sqs",
+    config=Config(max_pool_connections=AWS_POOL_SIZE, tcp_keepalive=True,
+                  retries={"mode": "adaptive", "max_attempts": 5}),
+)
 
 # ---------------------------------------------------------------------------
 ## DATABASE CONNECTION
@@ -66,23 +87,77 @@ conn.autocommit = True
 # ---------------------------------------------------------------------------
 ## JWT AUTH SETUP
 # ---------------------------------------------------------------------------
-# Load JWKS for JWT verification
-jwks = requests.get(JWKS_URL, timeout=3).json()
-key_set = {k['kid']: k for k in jwks['keys']}
+# The JWKS is fetched lazily and its parsed signing keys are kept by kid
+# for JWKS_TTL seconds, so rotated keys are picked up without a restart.
+jwks_client = PyJWKClient(JWKS_URL, lifespan=JWKS_TTL, timeout=3)
+token_cache: TTLCache = TTLCache(maxsize=10_000, ttl=TOKEN_CACHE_TTL)
+token_lock = threading.Lock()  # verify_jwt runs in the threadpool; TTLCache is not thread-safe
+jwks_lock = threading.Lock()
+jwks_keys: Dict[str, Any] = {}  # kid -> PyJWK, rebuilt only when the JWKS is fetched
+jwks_expires = 0.0       # monotonic time the current key map goes stale
+jwks_last_refresh = 0.0  # monotonic time of the last JWKS fetch
+
 
+def load_jwks() -> None:
+    """Fetch the JWKS and rebuild the kid -> PyJWK map (caller holds jwks_lock)."""
+    global jwks_keys, jwks_expires, jwks_last_refresh
+    keys = jwks_client.get_signing_keys(refresh=True)
+    jwks_keys = {k.key_id: k for k in keys}
+    jwks_last_refresh = time.monotonic()
+    jwks_expires = jwks_last_refresh + JWKS_TTL
 
-def verify_jwt(token: str = Depends(lambda req: req.headers.get("Authorization","").split()[-1])) -> Dict[str,Any]:
+
+def signing_key_for(kid: str):
     """
-    Ensure each request has a valid JWT bearer token.
+    Resolve `kid` from the prebuilt key map. The JWKS is refetched when
+    JWKS_TTL lapses; unknown kids force a refetch at most once per
+    JWKS_REFRESH_MIN seconds, so forged kids can't drive outbound requests.
     """
-    if not token:
+    key = jwks_keys.get(kid)
+    if key is not None and time.monotonic() < jwks_expires:
+        return key
+    with jwks_lock:
+        now = time.monotonic()
+        if now >= jwks_expires or (
+            kid not in jwks_keys and now - jwks_last_refresh >= JWKS_REFRESH_MIN
+        ):
+            load_jwks()
+        key = jwks_keys.get(kid)
+    if key is None:
+        raise jwt.PyJWKClientError(f'Unable to find a signing key that matches: "{kid}"')
+    return key
+
+
+def bearer_token(request: Request) -> str:
+    """Extract the bearer token from the Authorization header."""
+    auth_header = request.headers.get("Authorization", "")
+    if not auth_header.startswith("Bearer "):
         raise HTTPException(status_code=401, detail="Missing bearer token")
-    header = jose_jwt.get_unverified_header(token)
-    key_data = key_set.get(header['kid'])
-    if not key_data:
+    return auth_header[7:]
+
+
+def verify_jwt(token: str = Depends(bearer_token)) -> Dict[str,Any]:
+    """
+    Ensure each request has a valid JWT bearer token.
+    """
+    ## Repeat tokens skip the RSA verify until TOKEN_CACHE_TTL or `exp`
+    digest = hashlib.sha256(token.encode()).digest()
+    with token_lock:
+        cached = token_cache.get(digest)
+    if cached and cached.get('exp', float('inf')) > time.time():
+        return cached
+    try:
+        seg = token.split(".", 1)[0]
+        header = orjson.loads(base64.urlsafe_b64decode(seg + "=" * (-len(seg) % 4)))
+        signing_key = signing_key_for(header['kid'])
+    except (ValueError, KeyError, jwt.PyJWKClientError):
         raise HTTPException(status_code=401, detail="Invalid token key ID")
-    key = jwk.construct(key_data)
-    payload = jose_jwt.decode(token, key.to_dict(), algorithms=[header['alg']])
+    try:
+        payload = jwt.decode(token, signing_key.key, algorithms=["RS256"])
+    except jwt.InvalidTokenError:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    with token_lock:
+        token_cache[digest] = payload
     return payload  # returns claims, including `sub`
 
 # ---------------------------------------------------------------------------
@@ -129,14 +204,10 @@ def fetch_scopes_and_quotes(project_id: str) -> Dict[str, Any]:
 # ---------------------------------------------------------------------------
 ## HELPERS: IDENTIFY MISSING ITEMS & QUEUE FOR REVIEW
 # ---------------------------------------------------------------------------
-def identify_and_queue_gaps(
-    project_id: str, user_id: str, data: Dict[str, Any]
-) -> Dict[str, List[str]]:
+def identify_gaps(data: Dict[str, Any]) -> Dict[str, List[str]]:
     """
-    For each trade:
-      - compute expected minus quoted
-      - if any gaps, send to SQS review queue
-    Return dict of missing items per trade.
+    For each trade compute expected minus quoted.
+    Return dict of missing items per trade (trades without gaps omitted).
     """
     missing_map: Dict[str, List[str]] = {}
     for trade, expected in data['expected'].items():
@@ -144,28 +215,56 @@ def identify_and_queue_gaps(
         gaps = list(expected - quoted)
         if gaps:
             missing_map[trade] = gaps
-            # auto-queue for human review
-            if SCOPE_REVIEW_QUEUE_URL:
-                payload = {
-                    'project_id': project_id,
-                    'user_id': user_id,
-                    'trade': trade,
-                    'missing_items': gaps,
-                    'timestamp': __import__('time').time()
-                }
-                sqs.send_message(
-                    QueueUrl=SCOPE_REVIEW_QUEUE_URL,
-                    MessageBody=json.dumps(payload)
-                )
-                logger.info(f"Queued missing scope for review: {trade}, items={gaps}")
     return missing_map
 
+
+def queue_gaps_for_review(
+    project_id: str, user_id: str, missing_map: Dict[str, List[str]]
+) -> None:
+    """
+    Send one review message per trade to SQS, up to 10 per batch call.
+    Runs as a background task so SQS latency stays off the response path;
+    failed entries are re-sent, and any still unsent raise (surfaced as a
+    background-task error) rather than being dropped quietly.
+    """
+    now = time.time()  # one timestamp for the whole batch
+    entries = [
+        {
+            'Id': str(i),
+            'MessageBody': orjson.dumps({
+                'project_id': project_id,
+                'user_id': user_id,
+                'trade': trade,
+                'missing_items': gaps,
+                'timestamp': now
+            }).decode()
+        }
+        for i, (trade, gaps) in enumerate(missing_map.items())
+    ]
+    unsent: List[str] = []
+    for start in range(0, len(entries), SQS_BATCH_MAX):
+        batch = entries[start:start + SQS_BATCH_MAX]
+        for _ in range(SQS_SEND_ATTEMPTS):
+            resp = sqs.send_message_batch(QueueUrl=SCOPE_REVIEW_QUEUE_URL, Entries=batch)
+            failed = resp.get('Failed', [])
+            failed_ids = {f['Id'] for f in failed}
+            batch = [e for e in batch if e['Id'] in failed_ids]
+            if not batch:
+                break
+        for f in failed:
+            logger.error(f"Failed to queue scope review entry {f['Id']}: {f.get('Message')}")
+        unsent += [trade for i, trade in enumerate(missing_map) if str(i) in failed_ids]
+    if unsent:
+        raise RuntimeError(f"Scope review not queued for {project_id}, trades={unsent}")
+    logger.info(f"Queued missing scope for review: {project_id}, trades={list(missing_map)}")
+
 # ---------------------------------------------------------------------------
 ## ENDPOINT: POST /missing-scope
 # ---------------------------------------------------------------------------
 @app.post("/missing-scope")
 async def missing_scope(
     request: Request,
+    background_tasks: BackgroundTasks,
     auth: Dict[str, Any] = Depends(verify_jwt)
 ):
     """
@@ -179,10 +278,12 @@ async def missing_scope(
     if not project_id:
         raise HTTPException(status_code=400, detail="Missing project_id in request")
 
-    # Fetch data
-    data = fetch_scopes_and_quotes(project_id)
-    # Identify gaps & queue for review
-    missing = identify_and_queue_gaps(project_id, user_id, data)
+    # Fetch data (blocking psycopg2 calls run off the event loop)
+    data = await asyncio.to_thread(fetch_scopes_and_quotes, project_id)
+    # Identify gaps & auto-queue for human review once the response is sent
+    missing = identify_gaps(data)
+    if missing and SCOPE_REVIEW_QUEUE_URL:
+        background_tasks.add_task(queue_gaps_for_review, project_id, user_id, missing)
 
     return {
         'project_id': project_id,